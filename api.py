@@ -2,18 +2,20 @@ import firebase_admin
 import logging
 import os
 import re
-from flask import Flask, request, jsonify, render_template_string, abort
+from flask import Flask, Response, g, request, jsonify, render_template_string, abort
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, timezone
-from fetch_query import get_or_fetch_notams, fetch_notam_by_ids, fetch_notams_with_interpretations
+from fetch_query import get_or_fetch_notams, fetch_notam_by_ids, fetch_notams_with_interpretations, start_subscription_refresher
 from gpt_notam import fetch_interpret_and_insert_notams, generate_briefing
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS, cross_origin
 from flask_caching import Cache
 from firebase_admin import credentials, db
-from firebase_auth import auth_required
+from firebase_auth import auth_required, stream_auth_required
+from user_quota import get_user_quota, deduct_points
+from notam_subscriptions import split_locations, is_public_webhook_url, create_subscription, get_subscription, delete_subscription, stream_notam_changes
 
 app = Flask(__name__)
 CORS(app)
@@ -31,6 +33,12 @@ logger = logging.getLogger(__name__)
 RTDB_URL = os.getenv('RTDB_URL')
 DEFAULT_USER_POINTS = 5
 
+@app.before_request
+def start_background_jobs():
+    # Started per process on the first request, so that it also runs in forked workers
+    start_subscription_refresher()
+
+
 def is_valid_icao(codes):
     """Check if the given codes are valid ICAO codes."""
     pattern = re.compile(r'^[A-Z]{4}$')
@@ -65,24 +73,16 @@ def get_notams():
     today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
     uid = request.headers.get('uid')
 
-    # Fetch the user's data from Firebase RTDB
-    ref = db.reference(f'/users/{uid}')
-    user_data = ref.get()
-
-    # Check if user exists
-    if not user_data and not batch_load:
-        return jsonify({'error': 'User not found'}), 404
-
-    # Check and update points
+    # Check if user exists and has points left (daily reset is applied on sync)
     if not batch_load:
-        first_time_use = user_data.get('first_time_use')
-        current_time = datetime.utcnow()
-        if first_time_use is None or (current_time - datetime.fromisoformat(first_time_use)) > timedelta(hours=24): 
-            ref.update({
-                'points': user_data['maximum_points'],
-                'first_time_use': current_time.isoformat()
-            })
-        elif user_data['points'] <= 0:
+        try:
+            user_data = get_user_quota(uid)
+        except Exception as e:
+            logger.error(f"Failed to load quota for UID {uid}: {e}")
+            return jsonify({'error': 'User data is temporarily unavailable'}), 503
+        if not user_data:
+            return jsonify({'error': 'User not found'}), 404
+        if user_data['points'] <= 0:
             return jsonify({'error': 'You have exceeded your request limit'}), 429
 
     locations = request.args.getlist('locations')
@@ -102,9 +102,7 @@ def get_notams():
     notams, airports_fetched = get_or_fetch_notams(locations, start_date, end_date)
     
     if not batch_load:
-        ref.update({
-            'points': user_data['points'] - airports_fetched
-        })
+        deduct_points(uid, airports_fetched)
 
     if batch_load:
         notam_ids = [notam['notam_id'] for notam in notams]
@@ -151,6 +149,85 @@ def get_briefing(notams_id):
     return jsonify(final_notams), 200
 
 
+def _subscription_uid():
+    """
+    Returns the verified user's UID, or None if the 'uid' header names another user
+    or the request is an internal one, which has no user.
+    """
+    firebase_uid = getattr(g, 'firebase_uid', None)
+    uid = request.headers.get('uid')
+    if uid and uid != firebase_uid:
+        return None
+    return firebase_uid
+
+
+@app.route('/api/subscriptions', methods=['POST'])
+@auth_required
+@limiter.limit("30 per day")
+def post_subscription():
+    """
+    This endpoint subscribes the user to NOTAM changes for the given locations.
+    It accepts 'locations', and optionally 'start_date', 'end_date' and 'webhook_url' in the JSON body.
+    Changes are detected whenever the locations are refreshed and pushed to the webhook
+    or to the stream at /api/subscriptions/<subscription_id>/stream.
+    It returns the subscription ID.
+    """
+    uid = _subscription_uid()
+    if not uid:
+        return jsonify({'error': 'Forbidden: uid does not match the authentication token'}), 403
+    data = request.get_json(silent=True) or {}
+
+    locations = split_locations(data.get('locations') or [])
+    if not locations:
+        return jsonify({'error': 'Missing or empty locations parameter'}), 400
+
+    for location in locations:
+        if not is_valid_icao(location):
+            return jsonify({'error': f'Invalid ICAO code: {location}'}), 400
+
+    start_date = data.get('start_date')
+    end_date = data.get('end_date')
+    if (start_date and not is_valid_date(start_date)) or (end_date and not is_valid_date(end_date)):
+        return jsonify({'error': 'Invalid date format. Expected format: YYYY-MM-DD'}), 400
+
+    webhook_url = data.get('webhook_url')
+    if webhook_url and not is_public_webhook_url(webhook_url):
+        return jsonify({'error': 'webhook_url must be an https URL of a public host'}), 400
+
+    subscription_id = create_subscription(uid, locations, start_date, end_date, webhook_url)
+    return jsonify({'subscription_id': subscription_id}), 201
+
+
+@app.route('/api/subscriptions/<subscription_id>', methods=['DELETE'])
+@auth_required
+def remove_subscription(subscription_id):
+    uid = _subscription_uid()
+    if not uid:
+        return jsonify({'error': 'Forbidden: uid does not match the authentication token'}), 403
+    if not delete_subscription(uid, subscription_id):
+        return jsonify({'error': 'Subscription not found'}), 404
+    return jsonify({'message': 'Subscription deleted successfully'}), 200
+
+
+@app.route('/api/subscriptions/<subscription_id>/stream', methods=['GET'])
+@stream_auth_required
+def stream_subscription(subscription_id):
+    """
+    This endpoint streams the NOTAM changes of a subscription as Server-Sent Events.
+    Each 'notam_changes' event holds the new, replaced, cancelled and removed NOTAM IDs of one location.
+    Browsers using EventSource pass the Firebase ID token in the 'token' query parameter.
+    """
+    uid = _subscription_uid()
+    if not uid:
+        return jsonify({'error': 'Forbidden: uid does not match the authentication token'}), 403
+    subscription = get_subscription(uid, subscription_id)
+    if subscription is None:
+        return jsonify({'error': 'Subscription not found'}), 404
+
+    stream = stream_notam_changes(subscription['locations'], subscription.get('start_date'), subscription.get('end_date'))
+    return Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/api/clear_cache', methods=['POST'])
 def clear_cache():
     # Get the UID from the request headers or body
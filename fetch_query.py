@@ -5,12 +5,20 @@ import requests
 from datetime import datetime, timedelta, timezone
 from firebase_admin import db
 import hashlib
+import threading
+import time
+from notam_subscriptions import publish_notam_changes, get_subscribed_locations
 import os
 import re
 
 # load_dotenv()
 ICAO_KEY = os.getenv('ICAO_KEY')
 NOTAM_API_URL = os.getenv('NOTAM_API_URL') 
+SUBSCRIPTION_REFRESH_INTERVAL = int(os.getenv('SUBSCRIPTION_REFRESH_INTERVAL', 900))  # seconds
+SUBSCRIPTION_REFRESH_BATCH = 20  # locations per ICAO API call
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
 
 def hash_notam_id(input_string):
     return int(hashlib.sha256(input_string.encode()).hexdigest()[:8], 16)
@@ -152,8 +160,16 @@ def fetch_and_insert_notams(locations):
         None
     '''
     notams = call_notam_api(locations)
-    existing_notams_keys = check_existing_notams_keys(notams)
-    rows_to_insert = [prepare_notam_row(notam) for notam in notams if hash_notam_id(notam['key']) not in existing_notams_keys]
+    all_rows = [prepare_notam_row(notam) for notam in notams]
+
+    # Push the changes since the previous refresh to subscribers
+    try:
+        publish_notam_changes(locations, all_rows)
+    except Exception as e:
+        print(f"Publishing NOTAM changes failed: {e}")
+
+    existing_notams_keys = check_existing_notams_keys(notams) if notams else set()
+    rows_to_insert = [row for row in all_rows if row['notam_id'] not in existing_notams_keys]
 
     if rows_to_insert:
         client = bigquery.Client()
@@ -162,6 +178,58 @@ def fetch_and_insert_notams(locations):
         job = client.load_table_from_dataframe(dataframe, table_ref)
         job.result()
 
+def _claim_subscription_refresh():
+    '''
+    Claims the next subscription refresh in RTDB so that only one worker runs it per interval.
+    '''
+    current_time = time.time()
+    claimed = {}
+
+    def claim(last_run):
+        claimed['ok'] = not last_run or current_time - last_run >= SUBSCRIPTION_REFRESH_INTERVAL
+        return current_time if claimed['ok'] else last_run
+
+    db.reference('/subscription_refresh/last_run').transaction(claim)
+    return claimed['ok']
+
+
+def refresh_subscribed_locations():
+    '''
+    Fetches the NOTAMs of every location that has subscribers, so that their changes are
+    published even when no client requests them.
+    '''
+    locations = get_subscribed_locations()
+    for i in range(0, len(locations), SUBSCRIPTION_REFRESH_BATCH):
+        batch = locations[i:i + SUBSCRIPTION_REFRESH_BATCH]
+        try:
+            fetch_and_insert_notams(batch)
+        except Exception as e:
+            print(f"Refreshing subscribed locations {batch} failed: {e}")
+
+
+def _refresh_periodically():
+    while True:
+        try:
+            if _claim_subscription_refresh():
+                refresh_subscribed_locations()
+        except Exception as e:
+            print(f"Subscription refresh failed: {e}")
+        time.sleep(SUBSCRIPTION_REFRESH_INTERVAL)
+
+
+def start_subscription_refresher():
+    '''
+    Starts the background subscription refresh in the current process, once.
+    '''
+    global _refresher_pid
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid != os.getpid():
+            _refresher_pid = os.getpid()
+            threading.Thread(target=_refresh_periodically, daemon=True).start()
+
+
 def check_NOTAM(datefrom, dateto, notamfrom, notamto, PERM=False, EST=False):
     '''
     Checks if a NOTAM is active within a given date range.
@@ -217,12 +285,19 @@ def get_or_fetch_notams(locations, start_date, end_date, table='raw.notams_icao_
         return existing_notams, 0
     
     all_notams = call_notam_api(locations)
-    missing_notams = [notam for notam in all_notams if hash_notam_id(notam['key']) not in existing_keys]
+    all_rows = [prepare_notam_row(notam) for notam in all_notams]
+
+    # Push the changes since the previous refresh to subscribers
+    try:
+        publish_notam_changes(locations, all_rows)
+    except Exception as e:
+        print(f"Publishing NOTAM changes failed: {e}")
+
+    rows_to_insert = [row for row in all_rows if row['notam_id'] not in existing_keys]
 
     # Insert missing NOTAMs into BigQuery
-    if missing_notams:
+    if rows_to_insert:
         client = bigquery.Client()
-        rows_to_insert = [prepare_notam_row(notam) for notam in missing_notams]
         table_ref = client.dataset('raw').table('notams_icao_api')
         dataframe = pd.DataFrame(rows_to_insert)
         job = client.load_table_from_dataframe(dataframe, table_ref)
@@ -1,9 +1,18 @@
 import os
-from flask import Flask, request, jsonify, render_template_string
+import hashlib
+import threading
+import time
+from flask import Flask, g, request, jsonify, render_template_string
 from firebase_admin import credentials, db, auth
 from functools import wraps
 
 INTERNAL_AUTH_KEY = os.getenv("INTERNAL_AUTH_KEY")
+TOKEN_CACHE_MAX_TTL = int(os.getenv("TOKEN_CACHE_MAX_TTL", 300))  # seconds
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", 10000))
+
+# sha256(token) -> (expires_at, decoded_token)
+_token_cache = {}
+_token_cache_lock = threading.Lock()
 
 
 def _is_internal_request():
@@ -28,7 +37,57 @@ def _verify_firebase_token(token):
         return None
 
 
-def auth_required(f):
+def _get_cached_token(cache_key, now):
+    with _token_cache_lock:
+        entry = _token_cache.get(cache_key)
+        if entry is None:
+            return None
+        expires_at, decoded_token = entry
+        if expires_at <= now:
+            del _token_cache[cache_key]
+            return None
+        return decoded_token
+
+
+def _cache_token(cache_key, decoded_token, now):
+    # Never keep a token past its own 'exp', even if TOKEN_CACHE_MAX_TTL is longer
+    expires_at = min(now + TOKEN_CACHE_MAX_TTL, decoded_token.get('exp', now))
+    if expires_at <= now:
+        return
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            for key in [key for key, (exp, _) in _token_cache.items() if exp <= now]:
+                del _token_cache[key]
+            if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+                _token_cache.clear()
+        _token_cache[cache_key] = (expires_at, decoded_token)
+
+
+def verify_token_cached(token):
+    """
+    Verifies the Firebase token, reusing earlier successful verifications.
+    Only valid tokens are cached, for at most TOKEN_CACHE_MAX_TTL seconds and
+    never beyond the token's 'exp' claim. Google's signing certificates are
+    cached by firebase_admin itself according to their Cache-Control headers.
+    Args:
+    - token (str): The Firebase token.
+
+    Returns:
+    - dict: Decoded token if valid, None otherwise.
+    """
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    decoded_token = _get_cached_token(cache_key, now)
+    if decoded_token is not None:
+        return decoded_token
+
+    decoded_token = _verify_firebase_token(token)
+    if decoded_token is not None:
+        _cache_token(cache_key, decoded_token, now)
+    return decoded_token
+
+
+def _auth_decorator(f, allow_query_token):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         batch_load_str = request.args.get('batch_load', default='False').lower()
@@ -41,9 +100,11 @@ def auth_required(f):
                 return jsonify({'error': 'batch_load flag is not set for internal request'}), 400
       
         token = request.headers.get('Authorization')
+        if not token and allow_query_token:
+            token = request.args.get('token')
         if not token:
             return jsonify({'error': 'Authentication token is required'}), 401
-        decoded_token = _verify_firebase_token(token)
+        decoded_token = verify_token_cached(token)
 
         if decoded_token is None:
             return jsonify({'error': 'Invalid authentication token'}), 401
@@ -51,5 +112,19 @@ def auth_required(f):
         if batch_load is True:
             return jsonify({'error': 'batch_load flag is only available for internal requests'}), 400
 
+        g.firebase_uid = decoded_token.get('uid')
         return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+
+def auth_required(f):
+    return _auth_decorator(f, allow_query_token=False)
+
+
+def stream_auth_required(f):
+    """
+    Like auth_required, but also accepts the Firebase ID token in the 'token' query
+    parameter, since the browser EventSource API cannot send headers.
+    ID tokens expire after an hour, so a leaked stream URL is only valid briefly.
+    """
+    return _auth_decorator(f, allow_query_token=True)
\ No newline at end of file
@@ -0,0 +1,311 @@
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import sys
+import uuid
+from contextlib import contextmanager
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from google.cloud import bigquery
+
+ARCHIVE_DIR = os.getenv('NOTAM_ARCHIVE_DIR', 'notam_archive')
+VERSIONS_DIR = 'versions'
+LATEST_DIR = 'latest'
+UNKNOWN_FIR = 'UNKN'
+
+# Same columns as fetch_query.prepare_notam_row, plus the hash used to detect new versions
+ARCHIVE_SCHEMA = pa.schema([
+    ('processed_at', pa.timestamp('us', tz='UTC')),
+    ('notam_id', pa.int64()),
+    ('key', pa.string()),
+    ('raw_id', pa.string()),
+    ('location', pa.string()),
+    ('isICAO', pa.bool_()),
+    ('icao', pa.string()),
+    ('entity', pa.string()),
+    ('status', pa.string()),
+    ('Qcode', pa.string()),
+    ('Area', pa.string()),
+    ('SubArea', pa.string()),
+    ('Condition', pa.string()),
+    ('Subject', pa.string()),
+    ('Modifier', pa.string()),
+    ('message', pa.string()),
+    ('startdate', pa.timestamp('us', tz='UTC')),
+    ('enddate', pa.timestamp('us', tz='UTC')),
+    ('all', pa.string()),
+    ('Created', pa.timestamp('us', tz='UTC')),
+    ('type', pa.string()),
+    ('StateCode', pa.string()),
+    ('StateName', pa.string()),
+    ('criticality', pa.string()),
+    ('PERM', pa.bool_()),
+    ('EST', pa.bool_()),
+    ('version_hash', pa.string()),
+])
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string()), ('fir', pa.string())]), flavor='hive')
+LATEST_PARTITIONING = ds.partitioning(pa.schema([('fir', pa.string())]), flavor='hive')
+TIMESTAMP_COLUMNS = [field.name for field in ARCHIVE_SCHEMA if pa.types.is_timestamp(field.type)]
+STRING_COLUMNS = [field.name for field in ARCHIVE_SCHEMA if pa.types.is_string(field.type)]
+VERSION_FIELDS = ['key', 'all', 'status', 'type', 'startdate', 'enddate']
+
+FIR_PATTERN = re.compile(r'\bQ\)\s*([A-Z]{4})/')
+
+
+def _version_hash(notam):
+    content = '|'.join(str(notam.get(field)) for field in VERSION_FIELDS)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def _prepare_dataframe(rows):
+    df = pd.DataFrame([dict(row) for row in rows])
+    for field in ARCHIVE_SCHEMA:
+        if field.name not in df.columns and field.name != 'version_hash':
+            df[field.name] = None
+    for column in TIMESTAMP_COLUMNS:
+        df[column] = pd.to_datetime(df[column], utc=True, errors='coerce')
+    for column in STRING_COLUMNS:
+        if column != 'version_hash':
+            df[column] = df[column].map(lambda value: None if pd.isna(value) else str(value))
+    df['notam_id'] = df['notam_id'].astype('int64')
+    df['version_hash'] = [_version_hash(notam) for notam in df.to_dict('records')]
+    df['date'] = df['processed_at'].dt.strftime('%Y-%m-%d')
+    return df
+
+
+def _to_table(df):
+    return pa.Table.from_pandas(df[ARCHIVE_SCHEMA.names], schema=ARCHIVE_SCHEMA, preserve_index=False)
+
+
+def _write_table_atomic(table, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Leading dot so that datasets scanning the directory skip unfinished files
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _latest_path(archive_dir, fir):
+    return os.path.join(archive_dir, LATEST_DIR, f'fir={fir}', 'latest.parquet')
+
+
+@contextmanager
+def _fir_lock(archive_dir, fir):
+    '''
+    Serializes writers of one FIR across processes. The lock file starts with a dot,
+    so dataset scans skip it.
+    '''
+    path = os.path.join(archive_dir, LATEST_DIR, f'fir={fir}', '.lock')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _assign_firs(df, archive_dir):
+    '''
+    Returns one FIR per row, the same for every version of a NOTAM so that they share
+    one index: the FIR the NOTAM is already archived under, else the first Q) line FIR
+    among its rows, else its location.
+    '''
+    known_firs = {}
+    dataset = _dataset(archive_dir, LATEST_DIR, LATEST_PARTITIONING)
+    if dataset is not None:
+        table = dataset.to_table(columns=['notam_id', 'fir'], filter=ds.field('notam_id').isin(df['notam_id'].unique().tolist()))
+        known_firs = dict(zip(table['notam_id'].to_pylist(), table['fir'].to_pylist()))
+
+    q_firs = df['all'].str.extract(FIR_PATTERN)[0]
+    notam_firs = q_firs.groupby(df['notam_id']).transform('first')
+    return df['notam_id'].map(known_firs).fillna(notam_firs).fillna(df['location']).fillna(UNKNOWN_FIR)
+
+
+def _read_versions(archive_dir, fir, notam_ids):
+    dataset = _dataset(archive_dir, VERSIONS_DIR, PARTITIONING)
+    if dataset is None or not notam_ids:
+        return pd.DataFrame(columns=ARCHIVE_SCHEMA.names)
+    expression = (ds.field('fir') == fir) & ds.field('notam_id').isin(notam_ids)
+    return dataset.to_table(columns=ARCHIVE_SCHEMA.names, filter=expression).to_pandas()
+
+
+def _read_latest_fir(archive_dir, fir):
+    path = _latest_path(archive_dir, fir)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=ARCHIVE_SCHEMA.names)
+    return pq.read_table(path, memory_map=True).to_pandas()
+
+
+def archive_notams(rows, archive_dir=ARCHIVE_DIR):
+    '''
+    Archives NOTAM rows into Parquet files partitioned by processed_at date and FIR.
+
+    A row is only stored as a new version if its content differs from the archived version
+    preceding it, so repeated refreshes of unchanged NOTAMs take no space. Rows already
+    archived (same notam_id and processed_at) are skipped, so ranges can be archived again
+    or backfilled in any order. The latest version of every NOTAM is kept in a per-FIR index.
+
+    Args:
+        rows (list): NOTAM rows as returned by prepare_notam_row or read from BigQuery.
+        archive_dir (str): Root directory of the archive.
+
+    Returns:
+        int: Number of new versions written.
+    '''
+    if not rows:
+        return 0
+
+    df = _prepare_dataframe(rows)
+    df = df.sort_values('processed_at', kind='stable').drop_duplicates(['notam_id', 'processed_at'])
+    df['fir'] = _assign_firs(df, archive_dir)
+    df['archived'] = False
+
+    written = 0
+    for fir, fir_df in df.groupby('fir'):
+        with _fir_lock(archive_dir, fir):
+            latest = _read_latest_fir(archive_dir, fir)
+            backfill_ids = []
+            if not latest.empty:
+                latest_processed_at = fir_df['notam_id'].map(latest.set_index('notam_id')['processed_at'])
+                backfill_ids = fir_df.loc[latest_processed_at.notna() & (fir_df['processed_at'] <= latest_processed_at), 'notam_id'].unique().tolist()
+
+            # Rows newer than the index only need the latest version to compare with,
+            # older rows are placed within the full history of their NOTAM
+            history = pd.concat([latest[~latest['notam_id'].isin(backfill_ids)], _read_versions(archive_dir, fir, backfill_ids)], ignore_index=True)
+            history['archived'] = True
+            merged = pd.concat([history, fir_df], ignore_index=True)
+            merged = merged.sort_values(['notam_id', 'processed_at', 'archived'], ascending=[True, True, False], kind='stable')
+            merged = merged.drop_duplicates(['notam_id', 'processed_at'], keep='first')
+            previous_hash = merged.groupby('notam_id')['version_hash'].shift()
+            new_versions = merged[~merged['archived'].astype(bool) & (merged['version_hash'] != previous_hash)]
+            if new_versions.empty:
+                continue
+
+            for date, date_df in new_versions.groupby('date'):
+                path = os.path.join(archive_dir, VERSIONS_DIR, f'date={date}', f'fir={fir}', f'part-{uuid.uuid4().hex}.parquet')
+                _write_table_atomic(_to_table(date_df), path)
+
+            latest = pd.concat([latest, new_versions[ARCHIVE_SCHEMA.names]], ignore_index=True)
+            latest = latest.sort_values('processed_at', kind='stable').drop_duplicates('notam_id', keep='last')
+            _write_table_atomic(_to_table(latest), _latest_path(archive_dir, fir))
+            written += len(new_versions)
+
+    return written
+
+
+def compact_partitions(archive_dir=ARCHIVE_DIR):
+    '''
+    Merges the part files of every date/FIR partition into a single Parquet file.
+    '''
+    for partition in glob.glob(os.path.join(archive_dir, VERSIONS_DIR, 'date=*', 'fir=*')):
+        fir = os.path.basename(partition).split('=', 1)[1]
+        with _fir_lock(archive_dir, fir):
+            parts = sorted(glob.glob(os.path.join(partition, 'part-*.parquet')))
+            if len(parts) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(part, memory_map=True) for part in parts])
+            table = table.sort_by([('notam_id', 'ascending'), ('processed_at', 'ascending')])
+            _write_table_atomic(table, os.path.join(partition, f'part-{uuid.uuid4().hex}.parquet'))
+            for part in parts:
+                os.remove(part)
+
+
+def _dataset(archive_dir, subdir, partitioning):
+    path = os.path.join(archive_dir, subdir)
+    if not os.path.isdir(path):
+        return None
+    return ds.dataset(path, format='parquet', partitioning=partitioning, filesystem=fs.LocalFileSystem(use_mmap=True))
+
+
+def _location_filter(firs, locations):
+    expression = None
+    if firs:
+        expression = ds.field('fir').isin(list(firs))
+    if locations:
+        location_expression = ds.field('location').isin(list(locations))
+        expression = location_expression if expression is None else expression & location_expression
+    return expression
+
+
+def read_latest(firs=None, locations=None, archive_dir=ARCHIVE_DIR):
+    '''
+    Returns the latest archived version of every NOTAM, optionally filtered by FIR and location.
+    '''
+    dataset = _dataset(archive_dir, LATEST_DIR, LATEST_PARTITIONING)
+    if dataset is None:
+        return pd.DataFrame(columns=ARCHIVE_SCHEMA.names + ['fir'])
+    latest = dataset.to_table(filter=_location_filter(firs, locations)).to_pandas()
+    # A NOTAM is indexed under a single FIR, archives written before that may still hold it twice
+    return latest.sort_values('processed_at', kind='stable').drop_duplicates('notam_id', keep='last').reset_index(drop=True)
+
+
+def read_as_of(as_of, firs=None, locations=None, archive_dir=ARCHIVE_DIR):
+    '''
+    Returns the state of the archive as of the given time: for every NOTAM archived
+    by then, the version that was the latest at that time.
+
+    NOTAMs whose latest version is not newer than as_of are answered from the latest index;
+    only NOTAMs changed after as_of are looked up in the version partitions up to that date.
+
+    Args:
+        as_of (str | datetime): Point in time, naive values are treated as UTC.
+        firs (list, optional): FIRs to include.
+        locations (list, optional): Locations to include.
+        archive_dir (str): Root directory of the archive.
+
+    Returns:
+        DataFrame: One row per NOTAM.
+    '''
+    as_of = pd.Timestamp(as_of)
+    as_of = as_of.tz_localize('UTC') if as_of.tzinfo is None else as_of.tz_convert('UTC')
+
+    latest = read_latest(firs, locations, archive_dir)
+    current = latest[latest['processed_at'] <= as_of]
+    changed_ids = latest.loc[latest['processed_at'] > as_of, 'notam_id'].tolist()
+    if not changed_ids:
+        return current.reset_index(drop=True)
+
+    dataset = _dataset(archive_dir, VERSIONS_DIR, PARTITIONING)
+    expression = (
+        (ds.field('date') <= as_of.strftime('%Y-%m-%d'))
+        & (ds.field('processed_at') <= pa.scalar(as_of.to_pydatetime(), type=pa.timestamp('us', tz='UTC')))
+        & ds.field('notam_id').isin(changed_ids)
+    )
+    location_expression = _location_filter(firs, locations)
+    if location_expression is not None:
+        expression = expression & location_expression
+    history = dataset.to_table(filter=expression).to_pandas()
+    history = history.sort_values('processed_at', kind='stable').drop_duplicates('notam_id', keep='last')
+    history = history[[column for column in current.columns if column in history.columns]]
+
+    state = pd.concat([current, history], ignore_index=True)
+    return state.sort_values('processed_at', kind='stable').drop_duplicates('notam_id', keep='last').reset_index(drop=True)
+
+
+def archive_from_bigquery(start_date, end_date, archive_dir=ARCHIVE_DIR, table='raw.notams_icao_api'):
+    '''
+    Archives the rows processed between start_date (inclusive) and end_date (exclusive)
+    from the BigQuery raw table. Run it over consecutive ranges to keep the archive current.
+    '''
+    client = bigquery.Client()
+    query = f"""
+    SELECT * FROM notamify.{table}
+    WHERE processed_at >= TIMESTAMP('{start_date}') AND processed_at < TIMESTAMP('{end_date}')
+    ORDER BY processed_at
+    """
+    query_job = client.query(query)
+    rows = [{field: row[field] for field in row.keys()} for row in query_job.result()]
+    return archive_notams(rows, archive_dir)
+
+
+if __name__ == "__main__":
+    # python notam_archive.py 2023-07-01 2023-08-01
+    written = archive_from_bigquery(sys.argv[1], sys.argv[2])
+    compact_partitions()
+    print(f"Archived {written} NOTAM versions into {ARCHIVE_DIR}")
@@ -0,0 +1,352 @@
+import ipaddress
+import json
+import os
+import queue
+import re
+import socket
+import threading
+import uuid
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from firebase_admin import db
+
+WEBHOOK_TIMEOUT = int(os.getenv('WEBHOOK_TIMEOUT', 5))  # seconds
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 32))
+SSE_KEEPALIVE = 15  # seconds
+SSE_QUEUE_SIZE = 100
+
+REFERENCE_PATTERN = re.compile(r'\bNOTAM([RC])\s+([A-Z]\d{4}/\d{2})\b')
+
+_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS)
+
+# location -> (start_date, end_date) -> set of SSE listener queues
+_listeners = {}
+_listeners_lock = threading.Lock()
+_delta_listener = None
+
+
+def split_locations(locations):
+    '''
+    Flattens location parameters which may hold comma separated ICAO codes.
+    '''
+    return [code.strip() for location in locations for code in location.split(',') if code.strip()]
+
+
+def _notam_reference(notam):
+    '''
+    Returns ('R' | 'C', referenced NOTAM number) for NOTAMR/NOTAMC, None for NOTAMN.
+    '''
+    match = REFERENCE_PATTERN.search(notam.get('all') or '')
+    if match:
+        return match.group(1), match.group(2)
+    return None
+
+
+def _timestamp(value):
+    # RTDB drops None values, so missing dates arrive as absent keys
+    return pd.NaT if value is None else pd.to_datetime(value)
+
+
+def _isoformat(value):
+    value = pd.to_datetime(value)
+    return None if pd.isna(value) else value.isoformat()
+
+
+def _summarize_notam(notam):
+    return {
+        'notam_id': int(notam['notam_id']),
+        'key': notam.get('key'),
+        'type': notam.get('type'),
+        'startdate': _isoformat(notam.get('startdate')),
+        'enddate': _isoformat(notam.get('enddate')),
+        'PERM': bool(notam.get('PERM')),
+        'EST': bool(notam.get('EST'))
+    }
+
+
+def diff_notam_sets(previous, current):
+    '''
+    Computes the changes between two NOTAM sets of one location.
+
+    Args:
+        previous (dict): notam_id -> key of the previously seen NOTAMs.
+        current (list): NOTAM rows as returned by prepare_notam_row.
+
+    Returns:
+        dict: 'new' NOTAM summaries, 'replaced' and 'cancelled' NOTAMs referenced by new
+        NOTAMR/NOTAMC, and 'removed' NOTAM IDs that disappeared without a NOTAMC.
+    '''
+    current_ids = {int(notam['notam_id']) for notam in current}
+    # NOTAM keys look like 'A1234/23-EGLL', NOTAMR/NOTAMC reference 'A1234/23'
+    previous_by_number = {key.split('-')[0]: int(notam_id) for notam_id, key in previous.items() if key}
+
+    new, replaced, cancelled = [], [], []
+    for notam in current:
+        notam_id = int(notam['notam_id'])
+        if str(notam_id) in previous:
+            continue
+        new.append(_summarize_notam(notam))
+        reference = _notam_reference(notam)
+        if reference and reference[1] in previous_by_number:
+            referenced_id = previous_by_number[reference[1]]
+            if reference[0] == 'R':
+                replaced.append({'notam_id': referenced_id, 'replaced_by': notam_id})
+            else:
+                cancelled.append({'notam_id': referenced_id, 'cancelled_by': notam_id})
+
+    referenced_ids = {item['notam_id'] for item in replaced + cancelled}
+    removed = [int(notam_id) for notam_id in previous if int(notam_id) not in current_ids and int(notam_id) not in referenced_ids]
+
+    return {'new': new, 'replaced': replaced, 'cancelled': cancelled, 'removed': removed}
+
+
+def _filter_delta(delta, start_date, end_date):
+    '''
+    Restricts the new NOTAMs of a delta to the subscriber's time window.
+    Returns None if nothing is left to deliver.
+    '''
+    # Imported here because fetch_query publishes its changes through this module
+    from fetch_query import check_NOTAM
+
+    new = delta.get('new', [])
+    if start_date and end_date:
+        new = [notam for notam in new if check_NOTAM(pd.to_datetime(start_date), pd.to_datetime(end_date), _timestamp(notam.get('startdate')), _timestamp(notam.get('enddate')), notam.get('PERM', False), notam.get('EST', False))]
+    filtered = {
+        'location': delta['location'],
+        'detected_at': delta.get('detected_at'),
+        'new': new,
+        'replaced': delta.get('replaced', []),
+        'cancelled': delta.get('cancelled', []),
+        'removed': delta.get('removed', [])
+    }
+    if not (filtered['new'] or filtered['replaced'] or filtered['cancelled'] or filtered['removed']):
+        return None
+    return filtered
+
+
+def is_public_webhook_url(url):
+    '''
+    Checks that the webhook is an https URL whose host only resolves to public addresses,
+    so subscribers cannot make the server call loopback, private or link-local hosts.
+    '''
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme != 'https' or not parsed.hostname:
+            return False
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+    except (ValueError, socket.gaierror):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address[4][0].split('%')[0]).is_global for address in addresses)
+
+
+def _post_webhook(url, payload):
+    try:
+        # Checked again on delivery since the host may resolve differently than at subscription
+        if not is_public_webhook_url(url):
+            print(f"Webhook {url} skipped: not a public https URL")
+            return
+        response = requests.post(url, data=payload, headers={'Content-Type': 'application/json'}, timeout=WEBHOOK_TIMEOUT, allow_redirects=False)
+        if response.status_code >= 400:
+            print(f"Webhook {url} failed. Status code: {response.status_code}")
+    except Exception as e:
+        print(f"Webhook {url} failed: {e}")
+
+
+def _deliver_webhooks(location, delta):
+    # Runs on the executor, whose futures are never checked
+    try:
+        subscriptions = db.reference(f'/subscriptions/{location}').get() or {}
+    except Exception as e:
+        print(f"Loading subscriptions for {location} failed: {e}")
+        return
+
+    # Subscribers sharing a time window get the same payload, filter and serialize it once
+    windows = {}
+    for subscription in subscriptions.values():
+        if subscription.get('webhook_url'):
+            window = (subscription.get('start_date'), subscription.get('end_date'))
+            windows.setdefault(window, []).append(subscription['webhook_url'])
+
+    for (start_date, end_date), urls in windows.items():
+        try:
+            filtered = _filter_delta(delta, start_date, end_date)
+        except Exception as e:
+            print(f"Filtering NOTAM changes for {location} failed: {e}")
+            continue
+        if filtered is None:
+            continue
+        payload = json.dumps(filtered)
+        for url in urls:
+            _executor.submit(_post_webhook, url, payload)
+
+
+def _publish_location_changes(location, current, detected_at):
+    snapshot = {
+        'notams': {str(int(notam['notam_id'])): notam.get('key') for notam in current},
+        'updated_at': detected_at
+    }
+    previous = {}
+
+    def swap(stored):
+        # May run several times if another worker writes the snapshot concurrently
+        previous['snapshot'] = stored
+        return snapshot
+
+    try:
+        db.reference(f'/notam_snapshots/{location}').transaction(swap)
+        if previous['snapshot'] is None:
+            return
+
+        delta = diff_notam_sets(previous['snapshot'].get('notams') or {}, current)
+        if not (delta['new'] or delta['replaced'] or delta['cancelled'] or delta['removed']):
+            return
+        delta['location'] = location
+        delta['detected_at'] = detected_at
+
+        db.reference(f'/notam_deltas/{location}').set(delta)
+    except Exception as e:
+        print(f"Publishing NOTAM changes for {location} failed: {e}")
+        return
+    _deliver_webhooks(location, delta)
+
+
+def publish_notam_changes(locations, notams):
+    '''
+    Diffs the freshly fetched NOTAMs of every location against the previous snapshot
+    and pushes the changes to subscribers, in the background.
+
+    The snapshot (/notam_snapshots/{location}) only holds NOTAM IDs and keys and is
+    swapped in a transaction, so concurrent refreshes of a location never diff against
+    the same snapshot. The first refresh of a location only records the snapshot.
+    Deltas are written to /notam_deltas/{location}, from where every worker forwards
+    them to its SSE clients, and sent to the registered webhooks.
+
+    Args:
+        locations (list): The locations that were fetched.
+        notams (list): NOTAM rows as returned by prepare_notam_row.
+    '''
+    detected_at = datetime.now(timezone.utc).isoformat()
+    for location in split_locations(locations):
+        current = [notam for notam in notams if notam.get('location') == location]
+        _executor.submit(_publish_location_changes, location, current, detected_at)
+
+
+# Subscriptions
+
+def get_subscribed_locations():
+    '''
+    Returns the locations that have at least one subscription.
+    '''
+    return sorted((db.reference('/subscriptions').get(shallow=True) or {}).keys())
+
+
+def create_subscription(uid, locations, start_date=None, end_date=None, webhook_url=None):
+    '''
+    Registers a subscription to NOTAM changes for the given locations and time window.
+    The subscription is indexed per location so that a refresh only reads its own subscribers.
+
+    Returns:
+        str: The subscription ID.
+    '''
+    subscription_id = uuid.uuid4().hex
+    subscription = {
+        'uid': uid,
+        'start_date': start_date,
+        'end_date': end_date,
+        'webhook_url': webhook_url
+    }
+    updates = {f'subscriptions/{location}/{subscription_id}': subscription for location in locations}
+    updates[f'user_subscriptions/{uid}/{subscription_id}'] = dict(subscription, locations=locations)
+    db.reference('/').update(updates)
+    return subscription_id
+
+
+def get_subscription(uid, subscription_id):
+    return db.reference(f'/user_subscriptions/{uid}/{subscription_id}').get()
+
+
+def delete_subscription(uid, subscription_id):
+    '''
+    Removes the subscription. Returns False if the user has no such subscription.
+    '''
+    subscription = get_subscription(uid, subscription_id)
+    if subscription is None:
+        return False
+    updates = {f'subscriptions/{location}/{subscription_id}': None for location in subscription.get('locations', [])}
+    updates[f'user_subscriptions/{uid}/{subscription_id}'] = None
+    db.reference('/').update(updates)
+    return True
+
+
+# Server-Sent Events
+
+def _on_delta_event(event):
+    # Runs on the firebase_admin listener thread, an uncaught error would stop it for good
+    try:
+        _forward_delta(event)
+    except Exception as e:
+        print(f"Forwarding NOTAM changes failed: {e}")
+
+
+def _forward_delta(event):
+    # The first event holds the whole /notam_deltas tree, only forward later updates
+    if event.path == '/' or not isinstance(event.data, dict):
+        return
+    location = event.path.strip('/').split('/')[0]
+    delta = dict(event.data, location=location)
+
+    with _listeners_lock:
+        windows = {window: list(listeners) for window, listeners in _listeners.get(location, {}).items()}
+
+    for (start_date, end_date), listeners in windows.items():
+        filtered = _filter_delta(delta, start_date, end_date)
+        if filtered is None:
+            continue
+        message = json.dumps(filtered)
+        for listener in listeners:
+            try:
+                listener.put_nowait(message)
+            except queue.Full:
+                pass  # Slow client, it will miss this update
+
+
+def _ensure_delta_listener():
+    global _delta_listener
+    with _listeners_lock:
+        if _delta_listener is None:
+            _delta_listener = db.reference('/notam_deltas').listen(_on_delta_event)
+
+
+def stream_notam_changes(locations, start_date=None, end_date=None):
+    '''
+    Yields Server-Sent Events with the NOTAM changes for the given locations and time window.
+    '''
+    _ensure_delta_listener()
+    listener = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+    window = (start_date, end_date)
+    with _listeners_lock:
+        for location in locations:
+            _listeners.setdefault(location, {}).setdefault(window, set()).add(listener)
+
+    try:
+        yield ': connected\n\n'
+        while True:
+            try:
+                message = listener.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield f"event: notam_changes\ndata: {message}\n\n"
+    finally:
+        with _listeners_lock:
+            for location in locations:
+                listeners = _listeners.get(location, {}).get(window)
+                if listeners is not None:
+                    listeners.discard(listener)
+                    if not listeners:
+                        del _listeners[location][window]
+                    if not _listeners[location]:
+                        del _listeners[location]
@@ -0,0 +1,188 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from firebase_admin import db
+
+QUOTA_SYNC_INTERVAL = int(os.getenv('QUOTA_SYNC_INTERVAL', 30))  # seconds
+QUOTA_SYNC_BATCH = int(os.getenv('QUOTA_SYNC_BATCH', 5))  # points deducted locally before a sync
+QUOTA_RESET_PERIOD = timedelta(hours=24)
+
+# uid -> {'user_data': dict, 'pending': int, 'synced_at': float}
+_users = {}
+_users_lock = threading.Lock()
+_sync_locks = {}
+_flush_thread_pid = None
+
+
+def _needs_reset(user_data, current_time):
+    first_time_use = user_data.get('first_time_use')
+    return first_time_use is None or (current_time - datetime.fromisoformat(first_time_use)) > QUOTA_RESET_PERIOD
+
+
+def _apply_quota(user_data, deducted, period, current_time):
+    '''
+    Returns a copy of user_data with the deducted points and the daily reset applied.
+    The deducted points belong to the period starting at 'period' (the 'first_time_use'
+    they were counted against) and are dropped if that period has already been reset.
+    Used as the body of the RTDB transaction, so it must not have side effects.
+    '''
+    user_data = dict(user_data)
+    if user_data.get('first_time_use') == period:
+        user_data['points'] = user_data['points'] - deducted
+    if _needs_reset(user_data, current_time):
+        user_data['points'] = user_data['maximum_points']
+        user_data['first_time_use'] = current_time.isoformat()
+    return user_data
+
+
+def _sync_lock(uid):
+    with _users_lock:
+        return _sync_locks.setdefault(uid, threading.Lock())
+
+
+def _sync_user(uid):
+    '''
+    Flushes the points deducted locally for the user with a single RTDB transaction
+    and refreshes the cached user data with the result.
+    Concurrent writers (other workers, admin edits) are retried by the transaction,
+    so no deduction is lost.
+
+    Raises the RTDB error if the user has not been loaded yet, so that a failed first
+    load is not mistaken for a missing user. Later failures keep the cached data.
+    '''
+    with _sync_lock(uid):
+        with _users_lock:
+            entry = _users.get(uid)
+            deducted = entry['pending'] if entry else 0
+            loaded = entry is not None and entry['user_data'] is not None
+            period = entry['user_data'].get('first_time_use') if loaded else None
+
+        current_time = datetime.utcnow()
+
+        def update(current):
+            if current is None:
+                return None
+            return _apply_quota(current, deducted, period, current_time)
+
+        try:
+            user_data = db.reference(f'/users/{uid}').transaction(update)
+        except Exception as e:
+            print(f"Quota sync failed for {uid}: {e}")
+            if not loaded:
+                raise
+            return
+
+        with _users_lock:
+            if user_data is None:
+                _users.pop(uid, None)
+                return
+            entry = _users.setdefault(uid, {'pending': 0})
+            entry['pending'] -= deducted
+            entry['user_data'] = user_data
+            entry['synced_at'] = time.time()
+
+
+def get_user_quota(uid):
+    '''
+    Returns the user's data with 'points' reflecting deductions not yet synced to RTDB.
+    The user is read from RTDB on first use, after QUOTA_SYNC_INTERVAL and when the
+    daily reset is due; otherwise the in-process copy is used.
+
+    Returns:
+        dict: The user's data, or None if the user does not exist.
+
+    Raises:
+        Exception: If the user could not be loaded from RTDB.
+    '''
+    _ensure_flush_thread()
+    with _users_lock:
+        entry = _users.get(uid)
+        stale = (
+            entry is None
+            or entry['user_data'] is None
+            or time.time() - entry['synced_at'] > QUOTA_SYNC_INTERVAL
+            or _needs_reset(entry['user_data'], datetime.utcnow())
+        )
+
+    if stale:
+        _sync_user(uid)
+
+    with _users_lock:
+        entry = _users.get(uid)
+        if entry is None or entry['user_data'] is None:
+            return None
+        user_data = dict(entry['user_data'])
+        user_data['points'] -= entry['pending']
+        return user_data
+
+
+def deduct_points(uid, points):
+    '''
+    Deducts points from the user's quota in-process.
+    Deductions are written to RTDB once QUOTA_SYNC_BATCH points are pending,
+    and every QUOTA_SYNC_INTERVAL seconds by the background flush.
+    '''
+    if points <= 0:
+        return
+    _ensure_flush_thread()
+    with _users_lock:
+        entry = _users.setdefault(uid, {'pending': 0, 'user_data': None, 'synced_at': 0})
+        entry['pending'] += points
+        should_sync = entry['pending'] >= QUOTA_SYNC_BATCH
+    if should_sync:
+        try:
+            _sync_user(uid)
+        except Exception:
+            pass  # Already logged, the points stay pending for the next flush
+
+
+def _evict_idle_users():
+    '''
+    Drops users with nothing pending that have not been synced for QUOTA_SYNC_INTERVAL,
+    they are simply loaded again on their next request.
+    '''
+    idle_since = time.time() - QUOTA_SYNC_INTERVAL
+    with _users_lock:
+        for uid in [uid for uid, entry in _users.items() if not entry['pending'] and entry['synced_at'] < idle_since]:
+            lock = _sync_locks.get(uid)
+            if lock is not None and lock.locked():
+                continue
+            del _users[uid]
+            _sync_locks.pop(uid, None)
+
+
+def flush_user_quotas():
+    '''
+    Writes all pending deductions to RTDB and evicts idle users.
+    '''
+    with _users_lock:
+        uids = [uid for uid, entry in _users.items() if entry['pending']]
+    for uid in uids:
+        try:
+            _sync_user(uid)
+        except Exception:
+            pass  # Already logged, the points stay pending for the next flush
+    _evict_idle_users()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(QUOTA_SYNC_INTERVAL)
+        flush_user_quotas()
+
+
+def _ensure_flush_thread():
+    # Started lazily in every process, a thread started at import would only run
+    # in the gunicorn master when the app is preloaded
+    global _flush_thread_pid
+    if _flush_thread_pid == os.getpid():
+        return
+    with _users_lock:
+        if _flush_thread_pid != os.getpid():
+            _flush_thread_pid = os.getpid()
+            threading.Thread(target=_flush_periodically, daemon=True).start()
+
+
+atexit.register(flush_user_quotas)